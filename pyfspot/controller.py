@@ -5,14 +5,19 @@ import shutil
 import time
 import urllib
 from gettext import gettext as _
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import func, select, desc
 
 from models import NotFoundError, MissingBinaryError, \
-                   create_engine, metadata, session, \
-                   Photo, Tag, Meta
+                   create_engine, Session, uri_to_path, \
+                   Photo, Tag, Meta, phototags
+from utils import file_size, LRUCache
 
 
 DEFAULT_DB_FILE = os.path.join(os.path.expanduser('~'), '.config', 'f-spot', 'photos.db')
 DB_VERSION_ENCODED = 18
+DEFAULT_STAT_THREADS = 8
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +40,25 @@ def normalize(*args):
     return wrapper
 
 
+def top_directories(base_uris):
+    """
+    Map each base uri to its first level folder below the common root
+    of all of them.
+    """
+    folders = dict((b, uri_to_path(b).rstrip(os.sep).split(os.sep)) for b in base_uris)
+    depth = len(os.path.commonprefix(folders.values())) + 1
+    return dict((b, os.sep.join(parts[:depth]) or os.sep) for b, parts in folders.items())
+
+
+class CatalogLoggerAdapter(logging.LoggerAdapter):
+    """Prefix messages with the path of the catalog database"""
+    def process(self, msg, kwargs):
+        prefix = self.extra['dbpath']
+        if isinstance(msg, unicode) and not isinstance(prefix, unicode):
+            prefix = prefix.decode('utf-8', 'replace')
+        return "%s: %s" % (prefix, msg), kwargs
+
+
 class FSpotController(object):
 
     def __init__(self, **kwargs):
@@ -43,13 +67,26 @@ class FSpotController(object):
         self.dbpath = kwargs.get('dbpath')
         if not self.dbpath:
             self.dbpath = DEFAULT_DB_FILE
-        logger.debug(_("Using database file '%s'") % self.dbpath)
+        # Label messages when several catalogs are processed at once
+        self.logger = logger
+        if kwargs.get('labeled'):
+            self.logger = CatalogLoggerAdapter(logger, {'dbpath': self.dbpath})
+        self.logger.debug(_("Using database file '%s'") % self.dbpath)
         
-        engine = kwargs.get('engine')
-        if not engine:
-            engine = create_engine('sqlite:///%s' % self.dbpath)
-            metadata.bind = engine
-            session.configure(bind=engine)
+        # Each controller has its own engine and session, so that several
+        # catalogs can be opened at once.
+        self.engine = kwargs.get('engine')
+        if not self.engine:
+            self.engine = create_engine('sqlite:///%s' % self.dbpath)
+        self.session = kwargs.get('session')
+        if not self.session:
+            self.session = Session(bind=self.engine)
+
+        # Opt-in cache of resolved tag ids (max. entries)
+        self.cache = None
+        if kwargs.get('cache'):
+            self.cache = LRUCache(kwargs['cache'])
+        self._cache_stamp = None
 
         self._photoset = None
         self._db_version = None
@@ -57,7 +94,7 @@ class FSpotController(object):
     @property
     def photoset(self):
         if not self._photoset:
-            return session.query(Photo)
+            return self.session.query(Photo)
         return self._photoset
 
     @photoset.setter
@@ -68,19 +105,49 @@ class FSpotController(object):
         if self.backup:
             new = self.dbpath + '~%s' % time.strftime("%Y%m%d%H%M%S")
             shutil.copyfile(self.dbpath, new)
-            logger.info(_("Database backup created '%s'") % new)
+            self.logger.info(_("Database backup created '%s'") % new)
             # Do it once.
             self.backup = False
 
+    def _database_stamp(self):
+        """
+        Changes whenever the session transaction ends (commit or rollback,
+        which may discard flushed rows) or another process modifies the
+        database file.
+        """
+        try:
+            mtime = os.path.getmtime(self.dbpath)
+        except OSError:
+            mtime = None
+        return self.session.transaction, mtime
+
+    def _cached(self, key, compute):
+        """Return compute() result, memoized under key if cache is enabled"""
+        if self.cache is None:
+            return compute()
+        stamp = self._database_stamp()
+        if stamp != self._cache_stamp:
+            self.cache.clear()
+            self._cache_stamp = stamp
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+            self.cache.set(key, value)
+        return value
+
+    def invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
     @property
     def fspot_version(self):
-        m = session.query(Meta).filter_by(name="F-Spot Version").one()
+        m = self.session.query(Meta).filter_by(name="F-Spot Version").one()
         return m.data
 
     @property
     def db_version(self):
         if not self._db_version:
-            m = session.query(Meta).filter_by(name="F-Spot Database Version").one()
+            m = self.session.query(Meta).filter_by(name="F-Spot Database Version").one()
             self._db_version = int(m.data)
         return self._db_version
 
@@ -91,8 +158,9 @@ class FSpotController(object):
                 self.create_backup()
                 for p in queryset:
                     p.base_uri += os.sep
-                session.commit()
-                logger.info(_("Normalized path separator on %s photos.") % len(queryset))
+                self.session.commit()
+                self.invalidate_cache()
+                self.logger.info(_("Normalized path separator on %s photos.") % len(queryset))
             
             if self.db_version >= DB_VERSION_ENCODED:
                 total = 0
@@ -107,16 +175,23 @@ class FSpotController(object):
                         if base_uri_encoded != p.base_uri[7:]:
                             p.base_uri = p.base_uri[:7] + base_uri_encoded
                             total += 1
-                    session.commit()
-                    logger.info(_("Normalized path encoding on %s photos.") % total)
+                    self.session.commit()
+                    self.invalidate_cache()
+                    self.logger.info(_("Normalized path encoding on %s photos.") % total)
             self.normalize = False
 
     def find_by_tag(self, tag):
-        if isinstance(tag, basestring):
-            t = session.query(Tag).filter(Tag.name.like(tag)).first()
-        if not t:
-            raise NotFoundError(Tag, tag)
-        return self.photoset.filter(Photo.tags.any(id=t.id))
+        """
+        Photos of photoset with the tag. Only the tag id lookup is cached,
+        the photos are always queried.
+        """
+        def tag_id():
+            t = self.session.query(Tag).filter(Tag.name.like(tag)).first()
+            if not t:
+                raise NotFoundError(Tag, tag)
+            return t.id
+        tagid = self._cached(('tag', tag), tag_id)
+        return self.photoset.filter(Photo.tags.any(id=tagid))
 
     @normalize()
     def find_by_path(self, path):
@@ -140,8 +215,9 @@ class FSpotController(object):
                 continue
             p.rating = rating
             total += 1
-        logger.info(_("Set rating %s to %s photos.") % (rating, total))
-        session.commit()
+        self.logger.info(_("Set rating %s to %s photos.") % (rating, total))
+        self.session.commit()
+        self.invalidate_cache()
 
     def find_missing_on_disk(self):
         # Cannot use hybrid attributes yet.
@@ -154,7 +230,8 @@ class FSpotController(object):
         for p in self.photoset:
             p.add_tag(tagname)
             total += 1
-        logger.info(_("Added tag '%s' on %s photos.") % (tagname, total))
+        self.logger.info(_("Added tag '%s' on %s photos.") % (tagname, total))
+        self.invalidate_cache()
 
     @backupdb()
     def remove_tag(self, tagname):
@@ -164,8 +241,64 @@ class FSpotController(object):
                 p.remove_tag(tagname)
                 total += 1
             except Exception, e:
-                logger.error(e)
-        logger.info(_("Removed tag '%s' of %s photos.") % (tagname, total))
+                self.logger.error(e)
+        self.logger.info(_("Removed tag '%s' of %s photos.") % (tagname, total))
+        self.invalidate_cache()
+
+    def stats(self, disk_usage=False, threads=DEFAULT_STAT_THREADS):
+        """
+        Aggregate statistics of the photoset, computed with GROUP BY queries.
+        If disk_usage is set, files are also stat'ed (in parallel) to sum
+        their sizes per top-level directory.
+        """
+        photo_ids = select([self.photoset.with_entities(Photo.id).subquery().c.id])
+        in_photoset = Photo.id.in_(photo_ids)
+        photos = func.count(Photo.id).label('photos')
+        tagged = func.count(phototags.c.photo_id).label('photos')
+        year = func.strftime('%Y', Photo.time, 'unixepoch')
+
+        query = self.session.query
+        result = {}
+        result['total'] = query(photos).filter(in_photoset).scalar()
+        result['untagged'] = query(photos).filter(in_photoset) \
+                             .filter(~Photo.tags.any()).scalar()
+        result['tags'] = query(Tag.name, tagged) \
+                         .filter(Tag.id == phototags.c.tag_id) \
+                         .filter(phototags.c.photo_id.in_(photo_ids)) \
+                         .group_by(Tag.id, Tag.name) \
+                         .order_by(desc(tagged), Tag.name).all()
+        result['ratings'] = query(Photo.rating, photos).filter(in_photoset) \
+                            .group_by(Photo.rating) \
+                            .order_by(Photo.rating).all()
+        result['years'] = query(year, photos).filter(in_photoset) \
+                          .group_by(year).order_by(year).all()
+
+        # One row per folder, folded into top-level directories.
+        folders = query(Photo.base_uri, photos).filter(in_photoset) \
+                  .group_by(Photo.base_uri).all()
+        tops = top_directories([b for b, n in folders])
+        directories = {}
+        for base_uri, n in folders:
+            directories[tops[base_uri]] = directories.get(tops[base_uri], 0) + n
+        result['directories'] = sorted(directories.items())
+
+        if disk_usage:
+            rows = self.photoset.with_entities(Photo.base_uri, Photo.filename).all()
+            pool = ThreadPool(threads)
+            try:
+                sizes = pool.map(file_size, [uri_to_path(b, f) for b, f in rows])
+            finally:
+                pool.close()
+                pool.join()
+            usage = dict((top, 0) for top in directories)
+            for (base_uri, filename), size in zip(rows, sizes):
+                usage[tops[base_uri]] += size or 0
+            result['disk_usage'] = sorted(usage.items())
+            self.logger.debug(_("Stat'ed %s files on disk.") % len(rows))
+            failed = sizes.count(None)
+            if failed:
+                self.logger.info(_("Could not stat %s files, not counted in disk usage.") % failed)
+        return result
 
     def find_missing_in_catalog(self):
         raise NotImplementedError
@@ -175,8 +308,8 @@ class FSpotController(object):
             corrupted = [p.id for p in self.photoset if p.is_corrupted()]
         except MissingBinaryError, e:
             corrupted = []
-            logger.exception(e)
-            logger.info(_("Try installing with: sudo apt-get install %s") % e.cmd)
+            self.logger.exception(e)
+            self.logger.info(_("Try installing with: sudo apt-get install %s") % e.cmd)
         return self.photoset.filter(Photo.id.in_(corrupted or [-1]))
 
     def find_by_time(self):
@@ -2,20 +2,102 @@ import sys
 import logging
 import codecs 
 import locale 
+import json
+from multiprocessing import Pool
 from optparse import OptionParser, OptionGroup
 from gettext import gettext as _
 
-from controller import FSpotController
+from controller import FSpotController, CatalogLoggerAdapter
 
 logger = logging.getLogger(__name__)
 
 
+def print_stats(stats):
+    """Print statistics as plain text tables"""
+    print _("Photos   : %s") % stats['total']
+    print _("Untagged : %s") % stats['untagged']
+    sections = [('tags', _("Tag")),
+                ('ratings', _("Rating")),
+                ('years', _("Year")),
+                ('directories', _("Directory")),
+                ('disk_usage', _("Disk usage (bytes)"))]
+    for key, title in sections:
+        if key not in stats:
+            continue
+        print
+        print title
+        print '-' * len(title)
+        for name, value in stats[key]:
+            # Paths are byte strings, tag names unicode: print bytes like --list
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            print "%10s  %s" % (value, name)
+
+
+def process(dbpath, options):
+    """
+    Run the queries and actions of options on the catalog at dbpath.
+    Returns the listed photo paths and the statistics (if requested).
+    """
+    labeled = len(options.database or []) > 1
+    fm = FSpotController(dbpath=dbpath, labeled=labeled)
+    log = logger
+    if labeled:
+        log = CatalogLoggerAdapter(logger, {'dbpath': fm.dbpath})
+    log.info(_("F-Spot version  : %s") % fm.fspot_version)
+    log.debug(_("F-Spot database : %s") % fm.db_version)
+
+    # Chain find queries
+    if options.find_path:
+        path = unicode(options.find_path, 'utf8')
+        fm.photoset = fm.find_by_path(path)
+    if options.find_tag:
+        tagname = unicode(options.find_tag, 'utf8')
+        fm.photoset = fm.find_by_tag(tagname)
+    if options.find_missing:
+        fm.photoset = fm.find_missing_on_disk()
+    if options.find_corrupted:
+        fm.photoset = fm.find_corrupted()
+
+    if options.rating:
+        fm.change_rating(options.rating, options.safe_rating)
+    if options.tag:
+        fm.apply_tag(options.tag)
+    if options.untag:
+        fm.remove_tag(options.untag)
+
+    paths = []
+    if options.list:
+        paths = [p.path for p in fm.photoset]
+    stats = None
+    if options.stats:
+        stats = fm.stats(disk_usage=options.disk_usage)
+    return paths, stats
+
+
+def process_catalog(args):
+    """
+    Pool worker for process(). Failures are logged and give None,
+    instead of aborting the other catalogs.
+    """
+    dbpath, options = args
+    try:
+        return process(dbpath, options)
+    except Exception, e:
+        logger.error(_("Failed on database '%s'") % dbpath)
+        logger.exception(e)
+        return None
+
+
 def main(args=None):
     # Parse command-line arguments
     parser = OptionParser()
     parser.add_option("--database",
-                      dest="database", default=None,
-                      help=_("Path to F-Spot database"))
+                      dest="database", default=None, action="append",
+                      help=_("Path to F-Spot database (repeat to process several catalogs)"))
+    parser.add_option("--jobs",
+                      dest="jobs", default=None, type='int',
+                      help=_("Number of catalogs processed in parallel (default: number of CPUs)"))
     parser.add_option("--log-level",
                       dest="log_level", default=logging.INFO, type='int',
                       help=_("Logging level for messages (1:debug 2:info, 3:warning, 4:errors, 5:critical)"))
@@ -51,35 +133,33 @@ def main(args=None):
     actionsgrp.add_option("--untag",
                       dest="untag", default=None,
                       help=_("Remove specified tag"))
+    actionsgrp.add_option("--stats",
+                      dest="stats", default=False, action="store_true",
+                      help=_("Show statistics of photos matching set"))
+    actionsgrp.add_option("--stats-format",
+                      dest="stats_format", default="table", choices=["table", "json"],
+                      help=_("Statistics output format (table, json)"))
+    actionsgrp.add_option("--disk-usage",
+                      dest="disk_usage", default=False, action="store_true",
+                      help=_("Include disk usage per directory in statistics"))
     parser.add_option_group(lookupgrp)
     parser.add_option_group(actionsgrp)
     (options, args) = parser.parse_args(args)
     
     logging.basicConfig(level = options.log_level)
 
-    # Start using the controller
-    fm = FSpotController(dbpath=options.database)
-    logger.info(_("F-Spot version  : %s") % fm.fspot_version)
-    logger.debug(_("F-Spot database : %s") % fm.db_version)
-
-    # Chain find queries
-    if options.find_path:
-        path = unicode(options.find_path, 'utf8')
-        fm.photoset = fm.find_by_path(path)
-    if options.find_tag:
-        tagname = unicode(options.find_tag, 'utf8')
-        fm.photoset = fm.find_by_tag(tagname)
-    if options.find_missing:
-        fm.photoset = fm.find_missing_on_disk()
-    if options.find_corrupted:
-        fm.photoset = fm.find_corrupted()
-
-    if options.rating:
-        fm.change_rating(options.rating, options.safe_rating)
-    if options.tag:
-        fm.apply_tag(options.tag)
-    if options.untag:
-        fm.remove_tag(options.untag)
+    databases = options.database or [None]
+    if len(databases) == 1:
+        results = [process(databases[0], options)]
+    else:
+        # Run the same pipeline on every catalog, one process each
+        pool = Pool(options.jobs)
+        try:
+            results = pool.map(process_catalog, [(db, options) for db in databases])
+        finally:
+            pool.close()
+            pool.join()
+    labeled = len(databases) > 1
 
     # List photoset in stdout
     if options.list:
@@ -87,14 +167,38 @@ def main(args=None):
         #sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout)
         logger.debug(_("Default locale: %s") % locale.getdefaultlocale()[1])
         logger.debug(_("Terminal encoding (stdout): %s") % sys.stdout.encoding)
-        for p in fm.photoset:
-            print p.path
+        for dbpath, result in zip(databases, results):
+            if result is None:
+                continue
+            for path in result[0]:
+                if labeled:
+                    print "%s\t%s" % (dbpath, path)
+                else:
+                    print path
+
+    if options.stats:
+        allstats = [(dbpath, result[1]) for dbpath, result in zip(databases, results)
+                                        if result is not None]
+        if options.stats_format == 'json':
+            if labeled:
+                print json.dumps(dict(allstats), indent=2)
+            else:
+                print json.dumps(allstats[0][1], indent=2)
+        else:
+            for dbpath, stats in allstats:
+                if labeled:
+                    print
+                    print "== %s ==" % dbpath
+                print_stats(stats)
 
     if not any([options.list,
+                options.stats,
                 options.rating,
                 options.tag,
                 options.untag]):
         logger.warning(_("No action was specified."))
+    if None in results:
+        return 1
     return 0
 
 if __name__ == "__main__":
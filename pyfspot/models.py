@@ -8,7 +8,8 @@ import pexif
 
 from sqlalchemy import *
 from sqlalchemy.ext.declarative import declarative_base, synonym_for
-from sqlalchemy.orm import relation, relationship, sessionmaker, column_property
+from sqlalchemy.orm import relation, relationship, sessionmaker, column_property, \
+                           object_session
 
 from utils import which
 
@@ -38,6 +39,21 @@ class MissingBinaryError(Exception):
         super(MissingBinaryError, self).__init__(self, _("Cannot execute '%s'.") % cmd)
 
 
+def uri_to_path(base_uri, filename=None):
+    """
+    File system path of a base uri (and optional filename), as stored
+    in the photos table.
+    """
+    base_uri = urllib.unquote(base_uri)
+    base_uri = base_uri.encode('utf-8')
+    path = urlparse(base_uri).path
+    if filename is None:
+        return path
+    filename = urllib.unquote(filename)
+    filename = filename.encode('latin-1')
+    return os.path.join(path, filename)
+
+
 class Meta(DeclarativeBase):
     __tablename__ = 'meta'
 
@@ -110,12 +126,7 @@ class Photo(DeclarativeBase):
           becomes
             /photos/2011/11.01.09.Your photos/179.jpg
         """
-        base_uri = urllib.unquote(self.base_uri)
-        base_uri = base_uri.encode('utf-8')
-        base_uri = urlparse(base_uri)
-        filename = urllib.unquote(self.filename)
-        filename = filename.encode('latin-1')
-        return os.path.join(base_uri.path, filename)
+        return uri_to_path(self.base_uri, self.filename)
 
     def exists(self):
         """Exists on filesystem ?"""
@@ -135,12 +146,13 @@ class Photo(DeclarativeBase):
     def add_tag(self, tagname):
         """Add Tag with specified name. Create it if it does not exist"""
         if tagname.lower() not in [t.lower() for t in self.tagnames]:
-            self.tags.append(Tag.find_or_create(tagname))
+            self.tags.append(Tag.find_or_create(tagname, object_session(self) or session))
 
     def remove_tag(self, tagname):
         """Remove Tag with specified name. Raise exception if not set."""
         try:
-            self.tags.remove(session.query(Tag).filter_by(name=tagname).first())
+            db = object_session(self) or session
+            self.tags.remove(db.query(Tag).filter_by(name=tagname).first())
         except ValueError:
             raise Exception(_("Tag %s was not set on %s") % (tagname, self))
 
@@ -176,8 +188,8 @@ class Tag(DeclarativeBase):
         self.icon = kwargs.get('icon', '')
 
     @staticmethod
-    def find_or_create(tagname):
-        t = session.query(Tag).filter_by(name=tagname).first()
+    def find_or_create(tagname, db=session):
+        t = db.query(Tag).filter_by(name=tagname).first()
         if not t:
             t = Tag(name=tagname)
         return t
@@ -1,11 +1,20 @@
 # -*- coding: utf8 -*-
 import os
+import sys
+import json
+import logging
+import shutil
+import tempfile
 import unittest
+from StringIO import StringIO
 
 from fixture import DataSet, DataTestCase, SQLAlchemyFixture
 
-from models import create_engine, metadata, session, Photo, Tag, Meta
-from controller import FSpotController
+from models import create_engine, metadata, session, Session, NotFoundError, \
+                   Photo, Tag, Meta
+from controller import FSpotController, logger as controller_logger
+from main import main, print_stats
+from utils import LRUCache
 
 
 # Setup temporary database
@@ -48,6 +57,11 @@ class PhotoData(DataSet):
         description='file_normalized'
 
 
+class TagData(DataSet):
+    class insect:
+        name = 'Insect'
+
+
 class MetaData(DataSet):
     class fspot_version:
         name = 'F-Spot Version'
@@ -57,6 +71,21 @@ class MetaData(DataSet):
         data = '18'
         
 
+def create_catalog(tmpdir, tagname):
+    """Create a catalog file with one photo tagged tagname"""
+    dbpath = os.path.join(tmpdir, tagname + '.db')
+    e = create_engine('sqlite:///' + dbpath)
+    metadata.create_all(e)
+    s = Session(bind=e)
+    s.add(Meta(name='F-Spot Version', data='0.8.0'))
+    s.add(Meta(name='F-Spot Database Version', data='18'))
+    p = Photo(base_uri='file:///photos/', filename=tagname + '.jpg')
+    p.tags.append(Tag(name=tagname))
+    s.add(p)
+    s.commit()
+    return dbpath
+
+
 """
 Actual tests
 """
@@ -106,14 +135,30 @@ class TestPhoto(DataTestCase, unittest.TestCase):
         self.assertEqual(p.tagnames, [])
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        c = LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertTrue('a' in c)
+        self.assertFalse('b' in c)
+        self.assertEqual(len(c), 2)
+        c.clear()
+        self.assertEqual(c.get('a'), None)
+
+
 class TestController(DataTestCase, unittest.TestCase):
     fixture = dbfixture
-    datasets = [PhotoData, MetaData]
+    datasets = [PhotoData, TagData, MetaData]
 
     def setUp(self):
         super(TestController, self).setUp()
         self.fm = FSpotController(dbpath=DB_PATH, 
                                   engine=engine,
+                                  session=session,
                                   backup=False)
 
     def test_normalize(self):
@@ -164,5 +209,162 @@ class TestController(DataTestCase, unittest.TestCase):
         p = self.fm.find_missing_on_disk().all()
         self.assertEqual(len(p), n - 1)
 
+    def test_stats(self):
+        n = self.fm.photoset.count()
+        stats = self.fm.stats(disk_usage=True)
+        self.assertEqual(stats['total'], n)
+        self.assertEqual(stats['untagged'], n)
+        self.assertEqual(stats['tags'], [])
+        self.assertEqual(sum(c for d, c in stats['directories']), n)
+        bee = os.path.getsize(os.path.join(BASE_PATH, 'tests', 'bee.jpg'))
+        self.assertEqual(sum(s for d, s in stats['disk_usage']), bee)
+        # Limited to photoset
+        self.fm.photoset = self.fm.photoset.filter_by(filename='bee.jpg')
+        self.fm.apply_tag('Insect')
+        stats = self.fm.stats()
+        self.assertEqual(stats['total'], 1)
+        self.assertEqual(stats['untagged'], 0)
+        self.assertEqual(stats['tags'], [('Insect', 1)])
+        self.assertEqual(stats['directories'], [(os.path.join(BASE_PATH, 'tests'), 1)])
+        session.rollback()
+
+    def test_print_stats(self):
+        # Non-ASCII directories (encoded/normalized fixtures) and tag names
+        self.fm.photoset = self.fm.photoset.filter_by(filename='file1.jpg')
+        self.fm.apply_tag(u'Été')
+        self.fm.photoset = None
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            print_stats(self.fm.stats(disk_usage=True))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            session.rollback()
+        self.assertTrue(isinstance(output, str))
+        self.assertTrue(u'Été'.encode('utf-8') in output)
+        self.assertTrue(u'/éΩƂ'.encode('utf-8') in output)
+
+    def test_cache(self):
+        fm = FSpotController(dbpath=DB_PATH, engine=engine, session=session,
+                             backup=False, cache=10)
+        self.assertEqual(fm.find_by_tag('Insect').count(), 0)
+        self.assertEqual(len(fm.cache), 1)
+        # Hit: tag is not looked up anymore
+        tag = session.query(Tag).filter_by(name='Insect').one()
+        tag.name = 'Bug'
+        self.assertEqual(fm.find_by_tag('Insect').count(), 0)
+        # Own mutations invalidate
+        fm.change_rating(1)
+        self.assertEqual(len(fm.cache), 0)
+        self.assertRaises(NotFoundError, fm.find_by_tag, 'Insect')
+        tag.name = 'Insect'
+        session.commit()
+
+    def test_cache_rollback(self):
+        fm = FSpotController(dbpath=DB_PATH, engine=engine, session=session,
+                             backup=False, cache=10)
+        fm.apply_tag(u'newtag')
+        self.assertEqual(fm.find_by_tag(u'newtag').count(), fm.photoset.count())
+        # Cached id of a tag that is not committed
+        session.rollback()
+        self.assertRaises(NotFoundError, fm.find_by_tag, u'newtag')
+
+    def test_several_catalogs(self):
+        other = create_engine('sqlite:///' + DB_PATH)
+        metadata.create_all(other)
+        fm = FSpotController(dbpath=DB_PATH, engine=other, backup=False)
+        self.assertEqual(fm.photoset.count(), 0)
+        self.assertTrue(self.fm.photoset.count() > 0)
+        fm.session.add(Photo(base_uri='file:///other/', filename='other.jpg'))
+        fm.session.commit()
+        self.assertEqual(fm.photoset.count(), 1)
+        self.assertEqual(self.fm.photoset.filter_by(filename='other.jpg').count(), 0)
+
+class TestCatalogFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = create_catalog(self.tmpdir, 'alice')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_external_change(self):
+        fm = FSpotController(dbpath=self.dbpath, backup=False, cache=10)
+        self.assertEqual(fm.find_by_tag(u'alice').count(), 1)
+        # Rename through another connection
+        mtime = os.path.getmtime(self.dbpath)
+        other = Session(bind=create_engine('sqlite:///' + self.dbpath))
+        other.query(Tag).filter_by(name=u'alice').one().name = u'bob'
+        other.commit()
+        other.close()
+        # Filesystems with coarse mtime resolution
+        if os.path.getmtime(self.dbpath) == mtime:
+            os.utime(self.dbpath, (mtime + 1, mtime + 1))
+        self.assertRaises(NotFoundError, fm.find_by_tag, u'alice')
+        self.assertEqual(fm.find_by_tag(u'bob').count(), 1)
+        fm.session.close()
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.catalogs = [create_catalog(self.tmpdir, name) for name in ('alice', 'bob')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_main(self, args):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        sys.stdout.encoding = None
+        try:
+            code = main(args)
+            return code, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_several_catalogs(self):
+        args = ['--log-level=40']
+        for dbpath in self.catalogs:
+            args += ['--database', dbpath]
+        code, output = self.run_main(args + ['--list'])
+        self.assertEqual(code, 0)
+        self.assertEqual(output.splitlines(), ['%s\t/photos/alice.jpg' % self.catalogs[0],
+                                               '%s\t/photos/bob.jpg' % self.catalogs[1]])
+        code, output = self.run_main(args + ['--stats', '--stats-format=json'])
+        self.assertEqual(code, 0)
+        stats = json.loads(output)
+        self.assertEqual(sorted(stats.keys()), self.catalogs)
+        self.assertEqual(stats[self.catalogs[0]]['tags'], [['alice', 1]])
+
+    def test_labeled_logs(self):
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        controller_logger.addHandler(handler)
+        controller_logger.setLevel(logging.INFO)
+        try:
+            fm = FSpotController(dbpath=self.catalogs[0], backup=False, labeled=True)
+            fm.apply_tag(u'Été')
+            fm.change_rating(2)
+        finally:
+            controller_logger.removeHandler(handler)
+            controller_logger.setLevel(logging.NOTSET)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        for line in lines:
+            self.assertTrue(line.startswith(self.catalogs[0] + ': '))
+
+    def test_failing_catalog(self):
+        args = ['--log-level=50', '--find-tag=alice', '--list']
+        for dbpath in self.catalogs:
+            args += ['--database', dbpath]
+        code, output = self.run_main(args)
+        self.assertEqual(code, 1)
+        self.assertEqual(output.splitlines(), ['%s\t/photos/alice.jpg' % self.catalogs[0]])
+
+
 if __name__ == '__main__':
     unittest.main()
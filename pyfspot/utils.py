@@ -1,4 +1,5 @@
 import os
+from collections import OrderedDict
 
 
 def which(program):
@@ -19,3 +20,46 @@ def which(program):
                 return exe_file
 
     return None
+
+
+def file_size(path):
+    """
+    Size in bytes of the file at path, None if it cannot be read.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class LRUCache(object):
+    """
+    Mapping bounded to size items, the least recently used ones being
+    evicted first.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def set(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)